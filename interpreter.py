@@ -1,6 +1,10 @@
 from language import Instruction, Variable, Cmp
 
 class ExecutionState:
+    # states are created and touched for every executed instruction,
+    # fixed slots make the attribute access cheaper than a __dict__
+    __slots__ = ('pc', 'variables', 'values', 'error')
+
     def __init__(self, pc):
         # program counter
         self.pc = pc
@@ -56,6 +60,20 @@ class Interpreter:
     def __init__(self, program):
         self.program = program
 
+        # handlers of instructions that continue with the next
+        # instruction, looked up by the instruction type
+        self._handlers = {
+            Instruction.ADD: self.executeArith,
+            Instruction.SUB: self.executeArith,
+            Instruction.MUL: self.executeArith,
+            Instruction.DIV: self.executeArith,
+            Instruction.LOAD: self.executeMem,
+            Instruction.STORE: self.executeMem,
+            Instruction.CMP: self.executeCmp,
+            Instruction.PRINT: self.executePrint,
+            Instruction.ASSERT: self.executeAssert,
+        }
+
     def executeJump(self, state):
         jump = state.pc
         condval = state.eval(jump.get_condition())
@@ -187,21 +205,13 @@ class Interpreter:
         if ty == Instruction.JUMP:
             return self.executeJump(state)
 
-        if ty in [Instruction.ADD, Instruction.SUB,
-                  Instruction.MUL, Instruction.DIV]:
-            state =  self.executeArith(state)
-        elif ty in [Instruction.LOAD, Instruction.STORE]:
-            state = self.executeMem(state)
-        elif ty == Instruction.CMP:
-            state = self.executeCmp(state)
-        elif ty == Instruction.PRINT:
-            state = self.executePrint(state)
-        elif ty == Instruction.HALT:
+        if ty == Instruction.HALT:
             return None # kill the execution
-        elif ty == Instruction.ASSERT:
-            state = self.executeAssert(state)
-        else:
+
+        handler = self._handlers.get(ty)
+        if handler is None:
             raise RuntimeError(f"Unimplemented instruction: {instruction}")
+        state = handler(state)
 
         if not state.error:
             state.pc = state.pc.get_next_inst()
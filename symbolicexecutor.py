@@ -3,57 +3,142 @@
 from language import Instruction, Variable, Cmp
 from interpreter import ExecutionState, Interpreter
 from z3 import *
-from queue import LifoQueue
+from multiprocessing import get_context
+from collections import OrderedDict
+
+# z3 constants for the literals that eval converts most often,
+# saves a call into z3 for every use of such a literal
+# (read-only, executors extend their own copy of _INT_CACHE)
+_BOOL_T, _BOOL_F = BoolVal(True), BoolVal(False)
+_INT_CACHE = {i: IntVal(i) for i in range(-128, 257)}
+
+def _to_boolval(v, consts):
+    return _BOOL_T if v else _BOOL_F
+
+def _to_intval(v, consts):
+    c = consts.get(v)
+    return c if c is not None else IntVal(v)
+
+# conversion of literal operands to z3 values by their type
+_EVAL_DISPATCH = {bool: _to_boolval, int: _to_intval}
 
 
 class SymbolicExecutionState(ExecutionState):
-    def __init__(self, pc):
+    # new attributes must be listed here
+    __slots__ = ('path_cond', 'solver', 'consts', 'level', 'scope', 'pending',
+                 'unchecked', 'infeasible', '_shared')
+
+    def __init__(self, pc, solver=None, consts=_INT_CACHE):
         super().__init__(pc)
 
         # add constraints here
 
-        # dont forget to create _copy_ of attributes
-        # when forking states (i.e., dont use
-        # new.attr = old.attr, that would
-        # only create a reference)
+        # variables, values and path_cond are copy-on-write:
+        # copy() shares them between the states and _shared is set,
+        # so every method that modifies them must call _own() first
 
         self.path_cond = [True]
+        # Solver shared by the states (see SymbolicExecutor.activate).
+        # While the state runs, the solver has exactly path_cond
+        # asserted and the state's constraints live in the solver's
+        # scope number 'level' whose id is 'scope'. A state waiting
+        # in the stack keeps the constraints that are not asserted
+        # in its ancestors' scopes in 'pending', that is None while
+        # the state runs.
+        self.solver = Solver() if solver is None else solver
+        # z3 values of integer literals, shared by the states
+        self.consts = consts
+        self.level = 0
+        self.scope = None
+        self.pending = []
+        # number of jumps taken since path_cond was last
+        # checked to be satisfiable (0 if it is known to be)
+        self.unchecked = 0
+        # set once path_cond is found to be unsatisfiable
+        self.infeasible = False
+        self._shared = False
 
     def copy(self):
-        n = SymbolicExecutionState(self.pc)
-        n.variables = self.variables.copy()
-        n.values = self.values.copy()
-        n.path_cond = self.path_cond.copy()
+        # the copy is a waiting state
+        n = SymbolicExecutionState(self.pc, self.solver, self.consts)
+        n.variables = self.variables
+        n.values = self.values
+        n.path_cond = self.path_cond
+        n.level = self.level
+        n.scope = self.scope
+        n.pending = [] if self.pending is None else self.pending.copy()
         n.error = self.error
+        n.unchecked = self.unchecked
+        n._shared = self._shared = True
         return n
 
+    def _own(self):
+        # make private copies of the shared attributes before writing
+        if self._shared:
+            self.variables = self.variables.copy()
+            self.values = self.values.copy()
+            self.path_cond = self.path_cond.copy()
+            self._shared = False
+
+    def constrain(self, condval, replace=None):
+        # if replace is given, condval takes the place of the
+        # constraint at that index in path_cond (condval must imply it)
+        self._own()
+        if replace is None:
+            self.path_cond.append(condval)
+        else:
+            self.path_cond[replace] = condval
+        if self.pending is None:
+            self.solver.add(condval)
+        else:
+            self.pending.append(condval)
+
     def write(self, var, value):
         assert isinstance(var, Variable)
         assert isinstance(value, ExprRef)
+        self._own()
         self.variables[var] = value
 
     def eval(self, v):
-        if isinstance(v, bool):
-            return BoolVal(v) # convert int to z3 BoolVal
-        # NOTE: this must be before IntVal, since True/False
-        # match also IntVal
-        if isinstance(v, int):
-            return IntVal(v) # convert int to z3 IntVal
+        # dispatch on the exact type, bool is a subclass of int
+        convert = _EVAL_DISPATCH.get(type(v))
+        if convert is not None:
+            return convert(v, self.consts)
         assert isinstance(v, Instruction)
         return self.values.get(v)
 
     def set(self, lhs, val):
         assert isinstance(lhs, Instruction)
         assert isinstance(val, ExprRef)
+        self._own()
         self.values[lhs] = val
 
 class SymbolicExecutor(Interpreter):
-    def __init__(self, program):
+    def __init__(self, program, workers=1):
         super().__init__(program)
 
-        self.stack = LifoQueue()
+        self.workers = workers
+        self.stack = []
         self.executed_paths = 0
         self.errors = 0
+        # results of solved queries keyed by the ids of the query's
+        # constraints (z3 hash-conses ASTs, so equal ASTs share an id),
+        # the least recently used results are evicted
+        self._sat_cache = OrderedDict()
+        self._sat_cache_size = 1024
+        self._logic = self.getLogic(program)
+        # the solver shared by all states and the ids of its scopes
+        self.solver = SolverFor(self._logic)
+        self._scopes = []
+        self._scope_counter = 0
+        # how many jumps a path may take without checking
+        # its feasibility (1 checks at every symbolic jump)
+        self._check_every = 8
+        # symbols for the values of uninitialized variables by name
+        self._var_syms = {}
+        # z3 values of integer literals used by eval of the states
+        self._const_cache = dict(_INT_CACHE)
+        self.internConstants(program)
 
     def execProgram(self, state):
         state = self.executeInstruction(state)
@@ -63,27 +148,204 @@ class SymbolicExecutor(Interpreter):
     def solverError(self, path_cond):
         raise RuntimeError(f"Solver failed for: {path_cond}")
 
-    def evalPathCond(self, path_cond):
-        s = Solver()
-        s.add(path_cond)
-        return s.check()
+    def _is_trivially_unsat(self, path_cond, new):
+        # linear syntactic check: new is the negation of a constraint
+        # that is already on the path (or vice versa)
+        if is_false(new):
+            return True
+        neg = new.arg(0) if is_not(new) else None
+        for c in path_cond:
+            if not isinstance(c, BoolRef):
+                continue
+            if neg is not None and eq(c, neg):
+                return True
+            if is_not(c) and eq(c.arg(0), new):
+                return True
+        return False
+
+    def _isTriviallySat(self, path_cond, new):
+        # the state's path_cond is feasible, so adding nothing new
+        # to it cannot make it unsatisfiable
+        if is_true(new):
+            return True
+        return any(isinstance(c, BoolRef) and eq(c, new) for c in path_cond)
+
+    def _satCacheKey(self, path_cond, condval):
+        # return the key and the ASTs whose ids it consists of
+        exprs = tuple(c for c in path_cond if isinstance(c, AstRef)) + (condval,)
+        return tuple(c.get_id() for c in exprs), exprs
+
+    def guessPathCond(self, state, condval):
+        if self._is_trivially_unsat(state.path_cond, condval):
+            return unsat
+        return sat
+
+    def isFeasible(self, state):
+        if state.infeasible:
+            return False
+        if not state.unchecked:
+            return True
+        result = state.solver.check()
+        if result == unknown:
+            self.solverError(state.path_cond)
+        if result == sat:
+            state.unchecked = 0
+        else:
+            state.infeasible = True
+        return result == sat
+
+    def evalPathCond(self, state, condval):
+        if self._is_trivially_unsat(state.path_cond, condval):
+            return unsat
+        if not state.unchecked and self._isTriviallySat(state.path_cond, condval):
+            return sat
+
+        key, exprs = self._satCacheKey(state.path_cond, condval)
+        cached = self._sat_cache.get(key)
+        if cached is not None:
+            self._sat_cache.move_to_end(key)
+            return cached[0]
+
+        # probe condval on top of the state's path_cond as an
+        # assumption, so it is not kept asserted but the lemmas
+        # learned about path_cond are kept for further checks
+        result = state.solver.check(condval)
+
+        # keep the constraints alive along with the result,
+        # otherwise z3 could reuse their ids for other ASTs
+        self._sat_cache[key] = (result, exprs)
+        if len(self._sat_cache) > self._sat_cache_size:
+            self._sat_cache.popitem(last=False)
+        return result
+
+    def simplifyCond(self, condval):
+        # normalize the condition (constants folded, monomials moved
+        # to the left-hand side) so that trivially true/false or
+        # duplicate constraints never reach the solver
+        return simplify(condval, arith_lhs=True, som=True)
 
-    def getJumpBlock(self, state, path_cond, op_idx):
-        jump = state.pc
-        pc_state = state.copy()
-        successorblock = jump.get_operand(op_idx)
-        pc_state.path_cond = path_cond
-        pc_state.pc = successorblock[0]
-        return pc_state
+    def getExtendedPathCond(self, state, condval):
+        return state.path_cond + [condval]
+
+    def _getBound(self, c):
+        # recognize a (simplified) bound 't <= k' or 't >= k' on an
+        # integer term t, possibly negated, and return (t, is_upper, k)
+        negated = is_not(c)
+        if negated:
+            c = c.arg(0)
+        if not (is_le(c) or is_ge(c)):
+            return None
+        t, k = c.arg(0), c.arg(1)
+        if not (is_int(t) and is_int_value(k)):
+            return None
+        upper, k = is_le(c), k.as_long()
+        if negated:
+            # not(t <= k) is t >= k + 1, not(t >= k) is t <= k - 1
+            upper = not upper
+            k = k - 1 if upper else k + 1
+        return t, upper, k
+
+    def addPathCond(self, state, condval):
+        # Keep at most one lower and one upper bound per term, so that
+        # e.g. unrolling a loop 'i < n' does not accumulate the chain
+        # 'i < n, i + 1 < n, i + 2 < n, ...' but keeps only the range
+        # given by the tightest bounds.
+        if is_true(condval):
+            return
+        bound = self._getBound(condval)
+        if bound is not None:
+            t, upper, k = bound
+            for idx, c in enumerate(state.path_cond):
+                if not isinstance(c, BoolRef):
+                    continue
+                other = self._getBound(c)
+                if other is None or other[1] != upper or not eq(other[0], t):
+                    continue
+                if (k < other[2]) if upper else (k > other[2]):
+                    state.constrain(condval, replace=idx)
+                # else condval is implied by the existing bound
+                return
+        state.constrain(condval)
+
+    def internConstants(self, program):
+        # prebuild z3 values of all integer literals in the program,
+        # so that eval never constructs them while executing
+        for block in program:
+            for instruction in block:
+                ops = instruction.get_operands()
+                if instruction.get_ty() in [Instruction.JUMP, Instruction.ASSERT]:
+                    ops = ops + [instruction.get_condition()]
+                for op in ops:
+                    if type(op) is int and op not in self._const_cache:
+                        self._const_cache[op] = IntVal(op)
+
+    def getLogic(self, program):
+        # the path conditions are quantifier-free integer arithmetic,
+        # they are linear unless a multiplication has no constant
+        # operand or a division has a non-constant divisor
+        for block in program:
+            for instruction in block:
+                ty = instruction.get_ty()
+                if ty == Instruction.MUL:
+                    ops = instruction.get_operands()
+                elif ty == Instruction.DIV:
+                    ops = [instruction.get_operand(1)]
+                else:
+                    continue
+                if not any(isinstance(op, int) for op in ops):
+                    return "QF_NIA"
+        return "QF_LIA"
+
+    def pushScope(self, state):
+        # open a new solver scope for constraints of the running state
+        self.solver.push()
+        self._scope_counter += 1
+        self._scopes.append(self._scope_counter)
+        state.level = len(self._scopes)
+        state.scope = self._scope_counter
+
+    def activate(self, state):
+        # Make the shared solver hold the path condition of a waiting
+        # state. States forked from the same prefix share the solver
+        # scopes of the prefix, so only the constraints added after
+        # the fork need to be asserted. The stack is processed in LIFO
+        # order, so the scopes of a waiting state are normally still
+        # there; if they were popped (breadth-first seeding of parallel
+        # workers), the whole path condition is asserted anew.
+        level, scopes = state.level, self._scopes
+        if level <= len(scopes) and (level == 0 or scopes[level - 1] == state.scope):
+            self.solver.pop(len(scopes) - level)
+            del scopes[level:]
+            pending = state.pending
+        else:
+            self.solver.reset()
+            del scopes[:]
+            pending = state.path_cond
+        self.pushScope(state)
+        self.solver.add(pending)
+        state.pending = None
+
+    def copyState(self, state):
+        n = state.copy()
+        if state.pending is None:
+            # the copy waits on the current scopes, so the running
+            # state must not add any more constraints to them
+            self.pushScope(state)
+        return n
 
-    def queueJumpBlock(self, state, path_cond, op_idx):
-        pc_state = self.getJumpBlock(state, path_cond, op_idx)
-        self.stack.put(pc_state)
+    def moveToJumpBlock(self, state, condval, op_idx):
+        # continue with the state itself in the successor
+        successorblock = state.pc.get_operand(op_idx)
+        self.addPathCond(state, condval)
+        state.pc = successorblock[0]
+        return state
 
-    def getExtendedPathCond(self, state, condval):
-        path_cond = state.path_cond.copy()
-        path_cond.append(condval)
-        return path_cond
+    def getJumpBlock(self, state, condval, op_idx):
+        return self.moveToJumpBlock(self.copyState(state), condval, op_idx)
+
+    def queueJumpBlock(self, state, condval, op_idx):
+        pc_state = self.getJumpBlock(state, condval, op_idx)
+        self.stack.append(pc_state)
 
     def executeJump(self, state):
         jump = state.pc
@@ -95,45 +357,80 @@ class SymbolicExecutor(Interpreter):
         assert (isinstance(condval, BoolRef) or isinstance(condval, list) 
                 or condval in [True, False]),\
             f"Invalid condition: {exprs}"
-        
-        path_cond = self.getExtendedPathCond(state, condval)
-        not_path_cond = self.getExtendedPathCond(state, Not(condval))
 
-        cond_check = self.evalPathCond(path_cond)
-        not_cond_check = self.evalPathCond(not_path_cond)
+        condval = self.simplifyCond(condval)
+        # a concrete condition does not constrain the path,
+        # just continue in the (only) successor
+        if is_true(condval) or is_false(condval):
+            if state.unchecked:
+                # every jump counts, so that an infeasible path
+                # cannot loop on concrete jumps forever
+                state.unchecked += 1
+                if state.unchecked >= self._check_every \
+                        and not self.isFeasible(state):
+                    return None
+            successorblock = jump.get_operand(0 if is_true(condval) else 1)
+            state.pc = successorblock[0]
+            return state
 
-        if cond_check == unknown:
-            self.solverError(path_cond)
-        if not_cond_check == unknown:
-            self.solverError(not_path_cond)
+        not_condval = self.simplifyCond(Not(condval))
 
+        if state.unchecked + 1 < self._check_every:
+            # do not ask the solver, assume that both successors are
+            # feasible unless one is trivially not; an infeasible path
+            # is discarded once its feasibility gets checked
+            cond_check = self.guessPathCond(state, condval)
+            not_cond_check = self.guessPathCond(state, not_condval)
+            if state.unchecked or (cond_check == sat and not_cond_check == sat):
+                state.unchecked += 1
+        else:
+            cond_check = self.evalPathCond(state, condval)
+            not_cond_check = self.evalPathCond(state, not_condval)
+
+            if cond_check == unknown:
+                self.solverError(self.getExtendedPathCond(state, condval))
+            if not_cond_check == unknown:
+                self.solverError(self.getExtendedPathCond(state, not_condval))
+            if cond_check == sat or not_cond_check == sat:
+                state.unchecked = 0
+
+        if cond_check == unsat and not_cond_check == unsat and state.unchecked:
+            # the path itself is infeasible
+            state.infeasible = True
+            return None
+
+        # the state is not used after the jump, so it becomes
+        # the successor and only a forked successor is copied
         if cond_check == sat and not_cond_check == sat:
-            self.queueJumpBlock(state, not_path_cond, 1)
-            return self.getJumpBlock(state, path_cond, 0)
+            self.queueJumpBlock(state, not_condval, 1)
+            return self.moveToJumpBlock(state, condval, 0)
         elif cond_check == sat:
-            return self.getJumpBlock(state, path_cond, 0)
+            return self.moveToJumpBlock(state, condval, 0)
         elif not_cond_check == sat:
-            return self.getJumpBlock(state, not_path_cond, 1)
+            return self.moveToJumpBlock(state, not_condval, 1)
         else:
-            self.solverError()
+            self.solverError(state.path_cond)
 
         return state
 
     def handleUninitVar(self, state):
         instruction = state.pc
-        op = instruction.get_operand(0)
-        state.set(instruction, Int(op.get_name()))
-
-    def getNextState(self, state, path_cond):
-        next_state = state.copy()
-        next_state.path_cond = path_cond
+        name = instruction.get_operand(0).get_name()
+        sym = self._var_syms.get(name)
+        if sym is None:
+            sym = self._var_syms[name] = Int(name)
+        state.set(instruction, sym)
+
+    def getNextState(self, state, condval):
+        next_state = self.copyState(state)
+        self.addPathCond(next_state, condval)
         next_state.pc = next_state.pc.get_next_inst()
         return next_state
 
-    def queueNextState(self, state, path_cond):
-        pc_state = self.getNextState(state, path_cond)
+    def queueNextState(self, state, condval):
+        pc_state = self.getNextState(state, condval)
         if pc_state.pc:
-            self.stack.put(pc_state)
+            self.stack.append(pc_state)
         else:
             self.executed_paths += 1
 
@@ -154,43 +451,99 @@ class SymbolicExecutor(Interpreter):
 
         assert isinstance(condval, BoolRef), f"Invalid condition: {condval}"
 
-        path_cond = self.getExtendedPathCond(state, condval)
-        not_path_cond = self.getExtendedPathCond(state, Not(condval))
+        condval = self.simplifyCond(condval)
+        not_condval = self.simplifyCond(Not(condval))
 
-        cond_check = self.evalPathCond(path_cond)
-        not_cond_check = self.evalPathCond(not_path_cond)
+        cond_check = self.evalPathCond(state, condval)
+        not_cond_check = self.evalPathCond(state, not_condval)
 
         if cond_check == unknown:
-            self.solverError(path_cond)
+            self.solverError(self.getExtendedPathCond(state, condval))
         if not_cond_check == unknown:
-            self.solverError(not_path_cond)
+            self.solverError(self.getExtendedPathCond(state, not_condval))
 
         if cond_check == sat and not_cond_check == sat:
-            self.queueNextState(state, path_cond)
+            self.queueNextState(state, condval)
             self.assertError(state)
         elif not_cond_check == sat:
             self.assertError(state)
         elif cond_check == unsat and not_cond_check == unsat:
-            self.solverError()
+            self.solverError(state.path_cond)
         return state
 
-    def run(self):
-        entryblock = program.get_entry()
-        state = SymbolicExecutionState(entryblock[0])
-        self.stack.put(state)
-
-        while not self.stack.empty():
-            state = self.stack.get()
-
-            while state:
-                state = self.executeInstruction(state)
-                if state is None:
+    def runState(self, state):
+        # paths whose feasibility was not checked yet are checked
+        # before an assertion and before they are counted, infeasible
+        # paths are dropped silently
+        self.activate(state)
+        while True:
+            if state.unchecked and state.pc.get_ty() == Instruction.ASSERT:
+                if not self.isFeasible(state):
                     break
-                if state.error:
+            next_state = self.executeInstruction(state)
+            if next_state is None:
+                if self.isFeasible(state):
+                    self.executed_paths += 1
+                break
+            state = next_state
+            if state.error:
+                if self.isFeasible(state):
                     self.incErrorPaths()
-                    break
-            if state is None:
-                self.executed_paths += 1
+                break
+
+    def explore(self):
+        while self.stack:
+            self.runState(self.stack.pop())
+
+    def exploreWorker(self, states, paths, errors):
+        # explore the given subtrees and add the results
+        # to the counters shared with the parent process
+        self.stack = states
+        self.executed_paths = 0
+        self.errors = 0
+        self.explore()
+        with paths.get_lock():
+            paths.value += self.executed_paths
+        with errors.get_lock():
+            errors.value += self.errors
+
+    def exploreParallel(self):
+        # static partitioning: expand the tree breadth-first until
+        # there is a subtree for every worker, then let each worker
+        # explore its share of the subtrees in a forked process
+        # (z3 objects cannot be pickled, forked children inherit them)
+        while self.stack and len(self.stack) < self.workers:
+            self.runState(self.stack.pop(0))
+        if not self.stack:
+            return
+
+        ctx = get_context("fork")
+        paths = ctx.Value('i', 0)
+        errors = ctx.Value('i', 0)
+        procs = [ctx.Process(target=self.exploreWorker,
+                             args=(self.stack[i::self.workers], paths, errors))
+                 for i in range(self.workers)]
+        self.stack = []
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        if any(p.exitcode != 0 for p in procs):
+            raise RuntimeError("Symbolic execution worker failed")
+
+        self.executed_paths += paths.value
+        self.errors += errors.value
+
+    def run(self):
+        entryblock = self.program.get_entry()
+        state = SymbolicExecutionState(entryblock[0], self.solver,
+                                       self._const_cache)
+        self.stack.append(state)
+
+        if self.workers > 1:
+            self.exploreParallel()
+        else:
+            self.explore()
 
         print(f"Executed paths: {self.executed_paths}")
         print(f"Error paths: {self.errors}")
@@ -198,8 +551,12 @@ class SymbolicExecutor(Interpreter):
 if __name__ == "__main__":
     from parser import Parser
     from sys import argv
-    if len(argv) != 2:
-        print(f"Wrong number of arguments, usage: {argv[0]} <program>")
+    usage = f"usage: {argv[0]} <program> [workers]"
+    if len(argv) not in (2, 3):
+        print(f"Wrong number of arguments, {usage}")
+        exit(1)
+    if len(argv) == 3 and not (argv[2].isdigit() and int(argv[2]) > 0):
+        print(f"Invalid number of workers: {argv[2]}, {usage}")
         exit(1)
     parser = Parser(argv[1])
     program = parser.parse()
@@ -207,5 +564,6 @@ if __name__ == "__main__":
         print("Program parsing failed!")
         exit(1)
 
-    I = SymbolicExecutor(program)
+    workers = int(argv[2]) if len(argv) == 3 else 1
+    I = SymbolicExecutor(program, workers)
     exit(I.run())
@@ -17,11 +17,17 @@ TESTS=[
 ("sum.txt", 1, 0)
 ]
 
+# numbers of parallel workers to run the tests with (None = default)
+WORKERS=[None, 2]
+
 def main(se):
     total, failed = 0, 0
-    for program, nop, noe in TESTS:
+    for workers, (program, nop, noe) in ((w, t) for w in WORKERS for t in TESTS):
         total += 1
         cmd = ['python', abspath(se), abspath(join(dirname(argv[0]), program))]
+        if workers is not None:
+            cmd.append(str(workers))
+            program = f"{program} ({workers} workers)"
 
         #print('Running: ', " ".join(cmd))
         print(f"Running: {program}")